@@ -1,48 +1,248 @@
+import atexit
+import hashlib
+import io
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import os
+import queue
+import re
 import datetime
-
+import functools
+import threading
+import time
+from concurrent.futures import Future
+from string import Template
+
+import numpy as np
+import orjson
 import vertexai
 from flask import Flask, jsonify, request
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from cachetools import TTLCache
 
 import vertexai.generative_models
 from vertexai.preview.generative_models import GenerativeModel, Part
-from google.api_core.exceptions import InvalidArgument
-from vertexai.preview.prompts import Prompt
+from vertexai.language_models import TextEmbeddingModel
+from google.api_core.exceptions import (
+    DeadlineExceeded,
+    InvalidArgument,
+    NotFound,
+    ResourceExhausted,
+    ServiceUnavailable,
+)
 from vertexai.preview import caching
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.auth.transport.requests
 from google.auth import default
+from google.cloud import storage
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    Flask JSON provider backed by orjson, used by jsonify and request.get_json.
+    """
+
+    mimetype = "application/json"
+
+    def dumps_bytes(self, obj, **kwargs) -> bytes:
+        option = 0
+        if kwargs.pop("sort_keys", False):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.pop("indent", None):
+            option |= orjson.OPT_INDENT_2
+        default = kwargs.pop("default", None)
+        if kwargs:
+            raise TypeError(f"Unsupported orjson dumps arguments: {', '.join(kwargs)}")
+        return orjson.dumps(obj, default=default, option=option)
+
+    def dumps(self, obj, **kwargs) -> str:
+        return self.dumps_bytes(obj, **kwargs).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            raise TypeError(f"Unsupported orjson loads arguments: {', '.join(kwargs)}")
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if args and kwargs:
+            raise TypeError("app.json.response() takes either args or kwargs, not both")
+        if not args and not kwargs:
+            obj = None
+        elif len(args) == 1:
+            obj = args[0]
+        else:
+            obj = args or kwargs
+        # orjson's bytes go straight into the body, without a str round trip
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Configure CORS to allow requests from any origin
 CORS(app, resources={r"/": {"origins": "*"}})
 
+# Compress JSON responses (brotli or gzip, negotiated with the client)
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_LEVEL"] = 4
+app.config["COMPRESS_MIN_SIZE"] = 500
+Compress(app)
+
+# In-process cache of cleaned answers, keyed on the conversation and question
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", 3600))
+_answer_cache = TTLCache(
+    maxsize=int(os.environ.get("ANSWER_CACHE_SIZE", 1024)),
+    ttl=ANSWER_CACHE_TTL,
+)
+_answer_cache_lock = threading.Lock()
+
+# Optional semantic tier: recent question embeddings and their answers, stored
+# oldest first as (stored_at, history_key, embedding, answer) entries
+SEMANTIC_CACHE = os.environ.get("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.92))
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", 256))
+_semantic_entries = []
+_embedding_model = None
+
+# Local cleanup of markdown syntax and emojis in generated answers
+_MD_LINK_RE = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+_MD_RULE_RE = re.compile(r"^[ \t]*([-*_])(?:[ \t]*\1){2,}[ \t]*$", re.M)
+_MD_LINE_RE = re.compile(r"^[ \t]*(?:#{1,6}[ \t]+|>[ \t]?|[-*+][ \t]+)", re.M)
+# Paired emphasis, strike and code markers only; a lone "*" or "__init__" is kept
+_MD_INLINE_RE = re.compile(r"(?<![\w*])(\*{1,3}|~~|`+)(?=\S)(.+?)(?<=\S)\1(?![\w*])")
+_EMOJI_RE = re.compile(
+    "[\U0001F000-\U0001FAFF\U0001F1E6-\U0001F1FF\u2600-\u27BF\u2B00-\u2BFF"
+    "\uFE0F\u200D\u20E3\U000E0020-\U000E007F]"
+)
+
+# Generations currently in flight, keyed by answer cache key and cache version,
+# so concurrent identical requests share a single Gemini call
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Pooled HTTP session for Vertex AI REST calls, reused across requests
+_http = requests.Session()
+_http.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=50,
+        pool_maxsize=50,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+    ),
+)
+
+# Maximum number of characters of questions and answers written to the logs
+LOG_PAYLOAD_LIMIT = int(os.environ.get("LOG_PAYLOAD_LIMIT", 2000))
+
+# Default credentials, kept fresh by a background thread that refreshes the token
+# TOKEN_REFRESH_MARGIN before it expires, using a single auth transport
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+TOKEN_CHECK_INTERVAL = 60
+_creds = None
+_creds_lock = threading.Lock()
+_auth_request = google.auth.transport.requests.Request(session=_http)
+
+# Result of the last cached-content lookup, reused for a few minutes so repeated
+# refreshes don't re-list every cached content in the project
+CACHE_LOOKUP_TTL = datetime.timedelta(minutes=5)
+_cache_lookup = None
+_cache_lookup_time = None
+_cache_lookup_lock = threading.Lock()
+
+
+class _State:
+    """
+    Holds the live context cache and the model bound to it.
 
-def create_context_cache():
+    Refreshes build the new pair fully and then swap the attributes, so request
+    threads never need the global keyword and always see a usable model.
     """
-    Creates a Context Cache with system instructions and initial content.
+
+    cached_content = None
+    model = None
+
+
+STATE = _State()
+
+# Guards context cache refreshes. The version counts completed refreshes, so
+# concurrent requests that hit the same dead cache trigger a single rebuild
+_cache_lock = threading.Lock()
+_cache_version = 0
+
+# Context caches expire server-side after CONTEXT_CACHE_TTL unless extended. A
+# background job extends the live cache every BLOB_CHECK_INTERVAL seconds and
+# switches to a new one when the GCS blob's generation changes. _blob_gen is the
+# generation the live cache was built from, read from its display name
+CONTEXT_CACHE_TTL = datetime.timedelta(
+    hours=int(os.environ.get("CONTEXT_CACHE_TTL_HOURS", 24))
+)
+BLOB_CHECK_INTERVAL = int(os.environ.get("BLOB_CHECK_INTERVAL", 3600))
+_blob_gen = None
+
+
+@functools.lru_cache(maxsize=None)
+def load_system_instruction() -> str:
+    """
+    Loads the system instructions, reading the file only once per process.
 
     Returns:
-        A vertexai.preview.caching.CachedContent object.
+        The contents of system_instructions.txt.
     """
     try:
         with open("./system_instructions.txt", "r") as file:
             system_instruction = file.read()
         logger.info("Successfully loaded system instructions.")
+        return system_instruction
     except FileNotFoundError:
         logger.error("system_instructions.txt not found.", exc_info=True)
         raise  # Re-raise the exception to halt execution
+
+
+def context_cache_prefix() -> str:
+    """
+    Builds the display-name prefix of context caches for the current system instructions.
+
+    The prefix carries a hash of the instructions, so editing system_instructions.txt
+    makes the service stop reusing caches built from the old text. Each cache's
+    display name ends with the GCS generation of the document it was built from.
+
+    Returns:
+        The CACHE_NAME followed by a short digest of the system instructions and a dash.
+    """
+    digest = hashlib.sha256(load_system_instruction().encode()).hexdigest()[:12]
+    return f"{CACHE_NAME}-{digest}-"
+
+
+def create_context_cache():
+    """
+    Creates a Context Cache with system instructions and initial content.
+
+    The document is downloaded from GCS once and sent inline, so Vertex AI does not
+    have to fetch the object itself. The generation of the downloaded blob is
+    recorded in the cache's display name.
+
+    Returns:
+        A tuple of the vertexai.preview.caching.CachedContent object and the blob generation it holds.
+    """
+    system_instruction = load_system_instruction()
     try:
-        contents = Part.from_uri(
-            f"gs://{BUCKET_NAME}/{BLOB_NAME}",  # Added bucket and blob name
-            mime_type="text/markdown",
+        blob = storage_client.bucket(BUCKET_NAME).blob(BLOB_NAME)
+        data = blob.download_as_bytes()
+        contents = Part.from_data(data, mime_type="text/markdown")
+        logger.info(
+            f"Loaded content from gs://{BUCKET_NAME}/{BLOB_NAME} (generation {blob.generation})"
         )
-        logger.info(f"Loaded content from gs://{BUCKET_NAME}/{BLOB_NAME}")
     except Exception as e:
         logger.error(f"Error loading content from GCS: {e}", exc_info=True)
         raise
@@ -51,54 +251,92 @@ def create_context_cache():
             model_name="gemini-1.5-flash-002",
             system_instruction=system_instruction,
             contents=contents,
-            ttl=datetime.timedelta(days=360),
-            display_name=CACHE_NAME,
+            ttl=CONTEXT_CACHE_TTL,
+            display_name=f"{context_cache_prefix()}{blob.generation}",
         )
-        return cached_content
+        return cached_content, blob.generation
     except Exception as e:
         logger.error(f"Error creating context cache: {e}", exc_info=True)
         raise
 
 
-def fetch_cached_content():
+def remember_cached_content(cached_content, generation: int):
+    """
+    Records the result of a cached-content lookup or creation for CACHE_LOOKUP_TTL.
+
+    Args:
+        cached_content: The caching.CachedContent to reuse.
+        generation: The blob generation the cached content was built from.
+    """
+    global _cache_lookup, _cache_lookup_time
+    with _cache_lookup_lock:
+        _cache_lookup = (cached_content, generation)
+        _cache_lookup_time = datetime.datetime.now(datetime.timezone.utc)
+
+
+def fetch_cached_content(stale_name=None, generation=None):
     """
     Retrieves cached content from Vertex AI.
 
-    This function fetches cached content from Vertex AI. It first authenticates using
-    default credentials, then builds the request URL and headers.
+    This function fetches cached content from Vertex AI. A lookup made within the
+    last CACHE_LOOKUP_TTL is reused unless it is the cache known to be stale.
+    Otherwise it lists the cached contents over the pooled HTTP session, using the
+    token kept fresh by token_refresher, and picks the cache for the current system
+    instructions built from the newest (or the requested) blob generation.
 
     Args:
-        None: This function takes no parameters.
+        stale_name: Resource name of a cached content that just failed; the remembered
+            lookup is not reused for it, but the listing is still consulted.
+        generation: Only accept a cache built from this blob generation, if given.
 
     Returns:
-        caching.CachedContent: If a cached content with the specified name is found.
-        None: If no cached content with the specified name is found.
+        A tuple of the caching.CachedContent found and the blob generation it holds.
 
     Raises:
-        Exception: If an error occurs while fetching or parsing the cached content.
+        Exception: If no matching cached content exists or the listing fails.
     """
-    creds, _ = default()
-    auth_req = google.auth.transport.requests.Request()
-    creds.refresh(auth_req)
+    with _cache_lookup_lock:
+        if (
+            _cache_lookup is not None
+            and _cache_lookup[0].resource_name != stale_name
+            and generation in (None, _cache_lookup[1])
+            and datetime.datetime.now(datetime.timezone.utc) - _cache_lookup_time
+            < CACHE_LOOKUP_TTL
+        ):
+            return _cache_lookup
+
+    with _creds_lock:
+        if not _creds.valid:  # The background refresher fell behind
+            _creds.refresh(_auth_request)
+        token = _creds.token
 
     url = f"https://{LOCATION}-aiplatform.googleapis.com/v1beta1/projects/{PROJECT_ID}/locations/{LOCATION}/cachedContents"
-    headers = {"Authorization": f"Bearer {creds.token}"}
-    response = requests.request("GET", url, headers=headers).json()
+    headers = {"Authorization": f"Bearer {token}"}
+    prefix = context_cache_prefix()
     try:
-        response = requests.request("GET", url, headers=headers).json()
+        response = _http.get(url, headers=headers, timeout=10).json()
+        matches = {}
         for cached_content in response["cachedContents"]:
-            if cached_content["displayName"] == CACHE_NAME:
-                logging.info(f"Found context cache with name {cached_content["name"]}")
-                return caching.CachedContent(cached_content_name=cached_content["name"])
-
-        raise Exception
+            suffix = cached_content["displayName"].removeprefix(prefix)
+            if suffix != cached_content["displayName"] and suffix.isdigit():
+                matches[int(suffix)] = cached_content["name"]
+        if generation is not None:
+            matches = {g: n for g, n in matches.items() if g == generation}
+        if not matches:
+            raise Exception
+
+        found_generation = max(matches)
+        logging.info(f"Found context cache with name {matches[found_generation]}")
+        found = caching.CachedContent(cached_content_name=matches[found_generation])
+        remember_cached_content(found, found_generation)
+        return found, found_generation
 
     except Exception:
         logging.info("No cached content found.")
         raise  # Re-raise the exception to propagate the error
 
 
-def refresh_cached_context():
+def refresh_cached_context(stale=None):
     """
     Refreshes the cached context and generates a new model instance.
 
@@ -106,84 +344,395 @@ def refresh_cached_context():
     creates a new context cache. It then returns the cached content and a new
     GenerativeModel instance initialized with the cached content.
 
+    Args:
+        stale: The caching.CachedContent that just failed, if any; the remembered lookup
+            is bypassed for it so the listing is checked again.
+
     Returns:
-        A tuple containing the cached content and a new GenerativeModel instance.
+        A tuple containing the cached content, a new GenerativeModel instance and the blob generation.
 
     Raises:
         Exception: If an error occurs while fetching or creating the cached context.
     """
+    stale_name = stale.resource_name if stale is not None else None
     try:
-        cached_content = fetch_cached_content()
+        cached_content, generation = fetch_cached_content(stale_name)
     except Exception as e:
         logging.info(f"Creating new context cache because of error: {str(e)}")
-        cached_content = create_context_cache()
-    return cached_content, GenerativeModel.from_cached_content(cached_content)
+        cached_content, generation = create_context_cache()
+        remember_cached_content(cached_content, generation)
+    return cached_content, GenerativeModel.from_cached_content(cached_content), generation
 
 
-@retry(wait=wait_random_exponential(max=60), stop=stop_after_attempt(6))
-@app.route("/", methods=["GET", "POST", "OPTIONS"])
-def bot():
+def use_context_cache(cached_content, model, generation: int):
     """
-    Handles requests to the bot endpoint.
+    Makes a context cache and its model live, dropping answers built from another document.
 
-    GET: Returns a welcome message and status.
-    POST: Processes the user's question and context, generates a response from the LLM, and returns the answer.
-    OPTIONS: Handles CORS preflight requests.
+    Called with _cache_lock held, except during startup. The version is bumped in
+    the same _answer_cache_lock block that clears the answer caches, so answers
+    generated against the previous cache fail the version check in bot() and are
+    never stored afterwards.
 
-    Returns:
-        A JSON response containing the bot's answer or an error message, and the HTTP status code.
+    Args:
+        cached_content: The caching.CachedContent to serve from.
+        model: The GenerativeModel bound to it.
+        generation: The blob generation the cache was built from.
+    """
+    global _blob_gen, _cache_version
+    with _answer_cache_lock:
+        if generation != _blob_gen:
+            _answer_cache.clear()
+            _semantic_entries.clear()
+        STATE.model = model
+        STATE.cached_content = cached_content
+        _blob_gen = generation
+        _cache_version += 1
+
+
+def refresh_token_if_needed():
     """
-    global cached_content, model
-    if request.method == "GET":
-        logger.info("Received GET request.")
-        return "OK", 200
+    Refreshes the default credentials if the token is invalid or close to expiring.
+    """
+    with _creds_lock:
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if not _creds.valid or (
+            _creds.expiry is not None and _creds.expiry - now < TOKEN_REFRESH_MARGIN
+        ):
+            _creds.refresh(_auth_request)
+            logger.info("Refreshed Google auth token.")
+
 
-    if request.method == "POST":
+def token_refresher():
+    """
+    Refreshes the auth token ahead of expiry every TOKEN_CHECK_INTERVAL seconds, forever.
+    """
+    while True:
+        time.sleep(TOKEN_CHECK_INTERVAL)
         try:
-            request_json = request.get_json()
-            logger.info(
-                f"Received POST request with data: {request_json}"
-            )  # Log the actual request data
+            refresh_token_if_needed()
+        except Exception as e:
+            logger.error(f"Error refreshing Google auth token: {e}", exc_info=True)
+
+
+def context_cache_alive(cached_content) -> bool:
+    """
+    Checks whether a context cache still exists and has not expired.
+
+    Used to tell an expired cache apart from an InvalidArgument caused by the
+    request itself, such as a prompt over the token limit.
+
+    Args:
+        cached_content: The caching.CachedContent to check.
+
+    Returns:
+        False if Vertex AI no longer has the cache or it has expired, otherwise True.
+    """
+    try:
+        current = caching.CachedContent(cached_content_name=cached_content.resource_name)
+    except NotFound:
+        return False
+    except Exception as e:
+        logger.warning(f"Error checking the context cache, assuming it is alive: {e}")
+        return True
+    return current.expire_time > datetime.datetime.now(datetime.timezone.utc)
 
-            question = request_json["question"]
-            messages = request_json["messages"]
 
-            prompt = prompt_template.format(messages=messages, question=question)
+def refresh_model(seen_version: int):
+    """
+    Refreshes the cached context and model unless another request already did.
+
+    Runs on a background thread, so errors are logged rather than raised.
+
+    Args:
+        seen_version: The value of _cache_version observed before the failing call.
+    """
+    try:
+        with _cache_lock:
+            if _cache_version != seen_version:
+                logger.info("Context cache was already refreshed by another request.")
+                return
+            use_context_cache(*refresh_cached_context(stale=STATE.cached_content))
+    except Exception as e:
+        logger.error(f"Error refreshing the context cache: {e}", exc_info=True)
+
+
+def get_blob_generation() -> int:
+    """
+    Reads the current generation of the document blob in GCS.
+
+    Returns:
+        The blob's generation number, which changes whenever the object is rewritten.
+    """
+    return storage_client.bucket(BUCKET_NAME).get_blob(BLOB_NAME).generation
 
-            answer = model.generate_content(prompt)
 
+def check_blob():
+    """
+    Keeps the context cache in step with the document in GCS.
+
+    If the blob's generation differs from the one the live cache was built from, the
+    cache for the new generation is adopted: another worker or instance running this
+    same check may already have created it, so the listing is consulted before a new
+    cache is created. The old cache is not deleted, since other instances may still
+    be serving from it; once none of them extends it, it expires after
+    CONTEXT_CACHE_TTL. Otherwise the live cache's TTL is extended by
+    CONTEXT_CACHE_TTL. The check reschedules itself when done.
+    """
+    try:
+        generation = get_blob_generation()
+        if generation != _blob_gen:
             logger.info(
-                f"Successfully generated answer: {answer.candidates[0].text.strip()}"
-            )  # Log the answer
+                f"Blob generation changed from {_blob_gen} to {generation}, refreshing context cache."
+            )
+            with _cache_lock:
+                try:
+                    new_cached_content, new_generation = fetch_cached_content(
+                        generation=generation
+                    )
+                except Exception:
+                    new_cached_content, new_generation = create_context_cache()
+                    remember_cached_content(new_cached_content, new_generation)
+                use_context_cache(
+                    new_cached_content,
+                    GenerativeModel.from_cached_content(new_cached_content),
+                    new_generation,
+                )
+        else:
+            STATE.cached_content.update(ttl=CONTEXT_CACHE_TTL)
+            logger.info(f"Extended context cache TTL by {CONTEXT_CACHE_TTL}.")
+    except Exception as e:
+        logger.error(f"Error checking the document blob: {e}", exc_info=True)
+    finally:
+        schedule_blob_check()
 
-            text = clean_response(answer.candidates[0].text.strip())
 
-            json_array = {"answer": text}
-            logging.info("Processed answer")
+def schedule_blob_check():
+    """
+    Schedules the next check_blob run in BLOB_CHECK_INTERVAL seconds.
+    """
+    timer = threading.Timer(BLOB_CHECK_INTERVAL, check_blob)
+    timer.daemon = True
+    timer.start()
 
-        except InvalidArgument as e:
-            logger.info(f"Error querying the context cache: {str(e)}")
-            cached_content, model = refresh_cached_context()
 
-        except Exception as e:
-            logger.error(
-                f"Error processing POST request: {str(e)}", exc_info=True
-            )  # Include exc_info for stack trace
-            json_array = {
-                "error": str(e),
-                "answer": "I couldn't find an answer, please try again.",
-            }
+def truncate_for_log(text: str, limit: int = LOG_PAYLOAD_LIMIT) -> str:
+    """
+    Truncates a string for logging so large values stay cheap to log.
+
+    Args:
+        text: The string to log.
+        limit: Maximum number of characters to keep.
+
+    Returns:
+        The string cut to limit characters with a size marker.
+    """
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [truncated {len(text) - limit} chars]"
+
+
+def summarize_request(request_json) -> str:
+    """
+    Describes a POST body for logging without rendering the whole payload.
+
+    Args:
+        request_json: The parsed request body.
+
+    Returns:
+        The body size, the number of history messages and the truncated question.
+    """
+    if not isinstance(request_json, dict):
+        return f"{request.content_length} bytes of {type(request_json).__name__}"
+    messages = request_json.get("messages")
+    message_count = len(messages) if isinstance(messages, list) else None
+    question = request_json.get("question")
+    if isinstance(question, str):
+        question = truncate_for_log(question)
+    return (
+        f"{request.content_length} bytes, {message_count} messages, "
+        f"question: {question!r}"
+    )
+
+
+def answer_cache_key(messages, question) -> str:
+    """
+    Builds the exact-match cache key for a conversation and question.
+
+    Args:
+        messages: The conversation history sent by the client.
+        question: The user's question.
+
+    Returns:
+        The hex SHA-256 digest of the key-sorted JSON encoding of both values.
+    """
+    payload = orjson.dumps({"m": messages, "q": question}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+
+def history_cache_key(messages) -> str:
+    """
+    Builds the key a semantic cache entry's conversation history must match.
+
+    Args:
+        messages: The conversation history sent by the client.
+
+    Returns:
+        The hex SHA-256 digest of the key-sorted JSON encoding of the history.
+    """
+    return hashlib.sha256(orjson.dumps(messages, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def embed_question(question: str):
+    """
+    Computes a unit-normalized embedding of the question for the semantic cache.
+
+    Only the question is embedded: the history is matched exactly through
+    history_cache_key, and embedding it too would let text-embedding-004's input
+    truncation cut the question off in long conversations.
+
+    Args:
+        question: The user's question.
+
+    Returns:
+        A 1-D numpy array with unit L2 norm.
+    """
+    global _embedding_model
+    if _embedding_model is None:
+        _embedding_model = TextEmbeddingModel.from_pretrained("text-embedding-004")
+    values = _embedding_model.get_embeddings([question])[0].values
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def evict_expired_semantic_entries():
+    """
+    Drops semantic cache entries older than ANSWER_CACHE_TTL. Callers hold _answer_cache_lock.
+    """
+    cutoff = time.monotonic() - ANSWER_CACHE_TTL
+    while _semantic_entries and _semantic_entries[0][0] < cutoff:
+        del _semantic_entries[0]
+
+
+def has_semantic_candidates(history_key: str) -> bool:
+    """
+    Checks whether any live semantic cache entry shares the given history.
+
+    Lets bot() skip the embedding call when no entry could possibly match.
+
+    Args:
+        history_key: The history_cache_key of the incoming conversation.
+
+    Returns:
+        True if at least one unexpired entry has the same history_key.
+    """
+    with _answer_cache_lock:
+        evict_expired_semantic_entries()
+        return any(entry[1] == history_key for entry in _semantic_entries)
+
+
+def lookup_semantic_cache(history_key: str, embedding):
+    """
+    Finds the cached answer for the same history whose question embedding is closest to the given one.
+
+    Args:
+        history_key: The history_cache_key of the incoming conversation.
+        embedding: The unit-normalized embedding of the incoming question.
+
+    Returns:
+        The cached answer if its cosine similarity exceeds SEMANTIC_CACHE_THRESHOLD, otherwise None.
+    """
+    with _answer_cache_lock:
+        evict_expired_semantic_entries()
+        candidates = [entry for entry in _semantic_entries if entry[1] == history_key]
+        if not candidates:
+            return None
+        scores = np.dot(np.vstack([entry[2] for entry in candidates]), embedding)
+        best = int(np.argmax(scores))
+        if scores[best] > SEMANTIC_CACHE_THRESHOLD:
+            logger.info(f"Semantic cache hit with score {scores[best]:.3f}")
+            return candidates[best][3]
+    return None
+
+
+def store_semantic_cache(history_key: str, embedding, text: str, version: int):
+    """
+    Records a question embedding and its answer, evicting expired entries and the oldest entry when full.
+
+    Args:
+        history_key: The history_cache_key of the conversation.
+        embedding: The unit-normalized embedding of the question.
+        text: The cleaned answer to return on future matches.
+        version: The _cache_version the answer was generated under; the entry is
+            dropped if the context cache has been swapped since.
+    """
+    with _answer_cache_lock:
+        if _cache_version != version:
+            return
+        evict_expired_semantic_entries()
+        _semantic_entries.append((time.monotonic(), history_key, embedding, text))
+        if len(_semantic_entries) > SEMANTIC_CACHE_SIZE:
+            del _semantic_entries[0]
+
+
+def remember_semantic_answer(
+    history_key: str, question: str, embedding, text: str, version: int
+):
+    """
+    Adds an answer to the semantic cache, embedding the question first if needed.
+
+    Runs on a background thread so the embedding call stays off the response path.
+
+    Args:
+        history_key: The history_cache_key of the conversation.
+        question: The user's question.
+        embedding: The question's embedding if bot() already computed it, otherwise None.
+        text: The cleaned answer to return on future matches.
+        version: The _cache_version the answer was generated under.
+    """
+    try:
+        if embedding is None:
+            embedding = embed_question(question)
+        store_semantic_cache(history_key, embedding, text, version)
+    except Exception as e:
+        logger.error(f"Error storing semantic cache entry: {e}", exc_info=True)
+
+
+@retry(
+    wait=wait_random_exponential(max=60),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type(
+        (ServiceUnavailable, ResourceExhausted, DeadlineExceeded)
+    ),
+    reraise=True,
+)
+def generate_answer(prompt: str) -> str:
+    """
+    Streams a response from the model, retrying transient Vertex AI errors.
 
-        return jsonify(json_array), 200
+    Chunks are accumulated into a buffer and the full text is returned once the
+    stream ends; chunks without content parts (finish or usage-only chunks, safety
+    stops) are skipped. InvalidArgument is not retried: it means the context cache
+    is gone and has to be refreshed instead.
 
-    # OPTIONS requests are handled by Flask-CORS
-    return "", 204
+    Args:
+        prompt: The fully formatted prompt.
+
+    Returns:
+        The generated answer text, stripped of surrounding whitespace.
+    """
+    buffer = io.StringIO()
+    for chunk in STATE.model.generate_content(prompt, stream=True):
+        if chunk.candidates and chunk.candidates[0].content.parts:
+            buffer.write(chunk.text)
+    return buffer.getvalue().strip()
 
 
-@retry(wait=wait_random_exponential(max=60), stop=stop_after_attempt(6))
 def clean_response(answer: str) -> str:
     """
-    Cleans the LLM response by fixing capitalization, removing special characters and emojis.
+    Cleans the LLM response by removing markdown syntax and emojis and joining it into a single paragraph.
+
+    The system instructions already ask for plain text; this is a cheap local pass for
+    whatever slips through.
 
     Args:
         answer: The LLM generated response string.
@@ -191,58 +740,253 @@ def clean_response(answer: str) -> str:
     Returns:
         The cleaned response string.
     """
-    try:
-        prompt_obj = Prompt(
-            system_instruction="Convert markdown syntax to plain text, keep everything in a single paragraph, correct spelling and remove emojis.",
-            prompt_data=[answer],
-            model_name="gemini-1.5-flash-002",
-        )
-        llm_response = prompt_obj.generate_content(
-            contents=prompt_obj.assemble_contents(), stream=False
-        )
-        logger.info(f"Cleaned response: {llm_response.candidates[0].text.strip()}")
-        return llm_response.candidates[0].text.strip()
-    except Exception as e:
-        logger.error(f"Error cleaning response: {e}", exc_info=True)
-        return answer  # Return original answer if cleaning fails
+    text = _MD_LINK_RE.sub(r"\1", answer)
+    text = _MD_RULE_RE.sub("", text)
+    text = _MD_LINE_RE.sub("", text)
+    # Repeat until stable so nested markup such as "**bold *em* bold**" is fully unwrapped
+    while True:
+        stripped = _MD_INLINE_RE.sub(r"\2", text)
+        if stripped == text:
+            break
+        text = stripped
+    text = _EMOJI_RE.sub("", text)
+    return " ".join(text.split())
+
+
+def generate_coalesced(key: str, prompt: str, version: int) -> str:
+    """
+    Generates an answer, sharing one Gemini call among concurrent identical requests.
 
+    The first request for a key runs generate_answer; requests for the same key that
+    arrive while it is in flight wait for its result (or exception) instead. Requests
+    only join a generation started under the same _cache_version, so nobody receives
+    an answer from a context cache older than the one they saw.
 
-if __name__ == "__main__":
-    logger = logging.getLogger(__name__)
+    Args:
+        key: The answer cache key of the request.
+        prompt: The fully formatted prompt.
+        version: The _cache_version the request observed.
 
-    logger.info("Starting application...")
+    Returns:
+        The generated answer text.
+    """
+    inflight_key = (key, version)
+    with _inflight_lock:
+        future = _inflight.get(inflight_key)
+        leader = future is None
+        if leader:
+            future = _inflight[inflight_key] = Future()
+    if not leader:
+        logger.info("Joining in-flight generation for an identical request")
+        return future.result()
+
+    try:
+        text = generate_answer(prompt)
+        future.set_result(text)
+        return text
+    except BaseException as e:
+        # Also resolve on shutdown-style exceptions so followers never wait forever
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[inflight_key]
 
-    # Configure logging - Improved formatting and file handling
 
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Reports liveness and context cache churn for monitoring.
+
+    Returns:
+        A JSON response with the context cache version and blob generation, and the HTTP status code.
+    """
+    return (
+        jsonify(
+            {
+                "status": "ok",
+                "cache_version": _cache_version,
+                "blob_generation": _blob_gen,
+            }
+        ),
+        200,
     )
 
-    # Verify required environment variables
-    required_env_vars = ["BUCKET_NAME", "BLOB_NAME", "PROJECT_ID", "LOCATION"]
-    for var in required_env_vars:
-        if var not in os.environ:
-            raise EnvironmentError(f"Missing required environment variable: {var}")
 
-    # Load environment variables
-    BUCKET_NAME = os.environ["BUCKET_NAME"]
-    BLOB_NAME = os.environ["BLOB_NAME"]
-    PROJECT_ID = os.environ["PROJECT_ID"]
-    LOCATION = os.environ["LOCATION"]
-    CACHE_NAME = os.environ["CACHE_NAME"]
+@app.route("/", methods=["GET"])
+def index():
+    """
+    Answers load balancer and Cloud Run probes on the root path without touching the model.
 
-    # Load prompt template from file - with error handling
+    Flask adds OPTIONS to this rule automatically, so CORS preflight requests to the
+    root path are answered here, with Flask-CORS adding the headers.
+
+    Returns:
+        A plain "OK" and the HTTP status code.
+    """
+    return "OK", 200
+
+
+@app.route("/", methods=["POST"])
+def bot():
+    """
+    Handles requests to the bot endpoint.
+
+    POST: Processes the user's question and context, generates a response from the LLM, and returns the answer.
+          If the context cache has expired, it is rebuilt in the background and a 503 asks the client to retry.
+
+    Returns:
+        A JSON response containing the bot's answer or an error message, and the HTTP status code.
+    """
     try:
-        with open("./prompt_template.txt", "r") as file:
-            prompt_template = file.read()
-        logger.info("Successfully loaded prompt template.")
-    except FileNotFoundError:
-        logger.error("prompt_template.txt not found.", exc_info=True)
-        raise
+        request_json = request.get_json(cache=False)
+        logger.info(
+            f"Received POST request: {summarize_request(request_json)}"
+        )  # Log a bounded summary of the request data
+
+        question = request_json["question"]
+        messages = request_json["messages"]
+
+        key = answer_cache_key(messages, question)
+        with _answer_cache_lock:
+            cached_text = _answer_cache.get(key)
+        if cached_text is not None:
+            logger.info("Answer cache hit")
+            return jsonify({"answer": cached_text}), 200
+
+        prompt = prompt_template.substitute(messages=messages, question=question)
+
+        embedding = None
+        if SEMANTIC_CACHE:
+            history_key = history_cache_key(messages)
+            try:
+                if has_semantic_candidates(history_key):
+                    embedding = embed_question(question)
+                    cached_text = lookup_semantic_cache(history_key, embedding)
+            except Exception as e:
+                logger.error(f"Error querying semantic cache: {e}", exc_info=True)
+            if cached_text is not None:
+                return jsonify({"answer": cached_text}), 200
+
+        version = _cache_version
+        used_cache = STATE.cached_content
+        text = clean_response(generate_coalesced(key, prompt, version))
+        logger.info(
+            f"Successfully generated answer: {truncate_for_log(text)}"
+        )  # Log the answer
+
+        # Only cache the answer if the context cache was not swapped meanwhile
+        with _answer_cache_lock:
+            current = _cache_version == version
+            if current:
+                _answer_cache[key] = text
+        if SEMANTIC_CACHE and current:
+            threading.Thread(
+                target=remember_semantic_answer,
+                args=(history_key, question, embedding, text, version),
+                daemon=True,
+            ).start()
+
+        json_array = {"answer": text}
+        logging.info("Processed answer")
+
+    except InvalidArgument as e:
+        if version != _cache_version or not context_cache_alive(used_cache):
+            logger.info(f"Error querying the context cache: {str(e)}")
+            threading.Thread(target=refresh_model, args=(version,), daemon=True).start()
+            return (
+                jsonify(
+                    {
+                        "error": "cache_refreshing",
+                        "answer": "Please retry in a moment.",
+                    }
+                ),
+                503,
+            )
+        logger.error(f"Invalid request to the model: {str(e)}", exc_info=True)
+        json_array = {
+            "error": str(e),
+            "answer": "I couldn't find an answer, please try again.",
+        }
+
+    except Exception as e:
+        logger.error(
+            f"Error processing POST request: {str(e)}", exc_info=True
+        )  # Include exc_info for stack trace
+        json_array = {
+            "error": str(e),
+            "answer": "I couldn't find an answer, please try again.",
+        }
+
+    return jsonify(json_array), 200
+
+
+logger = logging.getLogger(__name__)
+
+# Configure logging - records are enqueued by a QueueHandler and written by a
+# QueueListener thread, so handler I/O stays off the request path
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+)
+log_queue = queue.Queue(-1)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener = QueueListener(log_queue, log_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger.info("Starting application...")
+
+# Verify required environment variables
+required_env_vars = ["BUCKET_NAME", "BLOB_NAME", "PROJECT_ID", "LOCATION"]
+for var in required_env_vars:
+    if var not in os.environ:
+        raise EnvironmentError(f"Missing required environment variable: {var}")
+
+# Load environment variables
+BUCKET_NAME = os.environ["BUCKET_NAME"]
+BLOB_NAME = os.environ["BLOB_NAME"]
+PROJECT_ID = os.environ["PROJECT_ID"]
+LOCATION = os.environ["LOCATION"]
+CACHE_NAME = os.environ["CACHE_NAME"]
+
+# Load prompt template from file - with error handling. The {messages} and
+# {question} placeholders are compiled once into a string.Template, so stray
+# braces in the template text are left alone.
+try:
+    with open("./prompt_template.txt", "r") as file:
+        prompt_template = Template(
+            file.read()
+            .replace("$", "$$")
+            .replace("{messages}", "${messages}")
+            .replace("{question}", "${question}")
+        )
+    logger.info("Successfully loaded prompt template.")
+except FileNotFoundError:
+    logger.error("prompt_template.txt not found.", exc_info=True)
+    raise
 
-    # Initialize Vertex AI
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
+# Initialize Vertex AI and the model at import time so WSGI servers such as
+# gunicorn, which import app:app rather than running this file, are ready to serve
+vertexai.init(project=PROJECT_ID, location=LOCATION)
 
-    cached_content, model = refresh_cached_context()
+_creds, _ = default()
+refresh_token_if_needed()
+threading.Thread(target=token_refresher, daemon=True).start()
+storage_client = storage.Client(project=PROJECT_ID)
 
+use_context_cache(*refresh_cached_context())
+
+# Send a tiny request so the first user doesn't pay the cold-start latency
+if os.environ.get("WARMUP", "1") == "1":
+    try:
+        STATE.model.generate_content("ping", generation_config={"max_output_tokens": 1})
+        logger.info("Warmed up the model.")
+    except Exception as e:
+        logger.warning(f"Model warm-up failed: {e}")
+
+schedule_blob_check()
+
+if __name__ == "__main__":
+    # Development server only; production runs under gunicorn (see Dockerfile)
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))